@@ -1,3 +1,12 @@
 from .tools import *
 from .grab_image_from_pdf import *
 
+from .frames import *
+from .attendance import *
+from .cassette import *
+from .store import *
+from .tenants import *
+from .workqueue import *
+from .history import *
+from .search import *
+from .transfer import *
@@ -0,0 +1,255 @@
+"""
+Attendance analytics for the frame returned by `get_all_attendance`.
+
+Everything is computed from a (person, week) table of counts, so the raw
+attendance rows only have to be looked at once. `AttendanceStats.update` adds
+new rows to that table, which lets a dashboard append the latest weeks
+instead of recomputing everything.
+"""
+import numpy as np
+import pandas as pd
+
+
+__all__ = ["AttendanceStats",
+           "attendance_counts",
+           "last_seen",
+           "rolling_participation",
+           "attendance_streaks",
+           "lapsed_members",
+           "event_totals"]
+
+
+#default column names in the attendance frame
+UID_COLUMN = "uid"
+DATE_COLUMN = "date"
+EVENT_COLUMN = "name"
+
+#weeks run Sunday to Saturday
+WEEK_FREQ = "W-SAT"
+
+
+def _week_start(dates):
+    """Helper function to get the Sunday that starts the week of each date
+    """
+    return dates.dt.to_period(WEEK_FREQ).dt.start_time
+
+
+def _week_grid(start, end):
+    """Helper function to get every week start from start to end
+    """
+    return pd.date_range(start, end, freq="W-SUN")
+
+
+def _presence_matrix(weekly, as_of=None):
+    """Helper function to turn (uid, week) counts into a uid x week array of
+    counts with a column for every week, including weeks nobody came
+    """
+    if weekly.empty:
+        return pd.DataFrame()
+    matrix = weekly.unstack(fill_value=0)
+    end = matrix.columns.max()
+    if as_of is not None:
+        end = _week_start(pd.Series([pd.Timestamp(as_of)])).iloc[0]
+    grid = _week_grid(matrix.columns.min(), end)
+    return matrix.reindex(columns=grid, fill_value=0)
+
+
+class AttendanceStats:
+    """Running attendance totals that can be updated as new weeks come in
+
+    Parameters
+    ----------
+    uid_column : `str`, optional (default: "uid")
+    date_column : `str`, optional (default: "date")
+    event_column : `str`, optional (default: "name")
+        Column names in the attendance frame. Rows without a parsable date
+        are ignored. If the event column is missing, `event_totals` is empty
+
+    Examples
+    --------
+    >>> stats = AttendanceStats()
+    >>> stats.update(get_all_attendance(session_id, write=False))
+    >>> stats.update(get_all_attendance(session_id, number_of_weeks=1, write=False))
+    >>> stats.lapsed_members(weeks=8)
+
+    """
+
+    def __init__(self, uid_column=UID_COLUMN, date_column=DATE_COLUMN,
+                 event_column=EVENT_COLUMN):
+        self.uid_column = uid_column
+        self.date_column = date_column
+        self.event_column = event_column
+        #(uid, week) -> number of events attended that week
+        self.weekly = pd.Series(dtype="int64")
+        #uid -> most recent date attended
+        self.last_dates = pd.Series(dtype="datetime64[ns]")
+        #(event, uid) -> number of times attended
+        self.event_people = pd.Series(dtype="int64")
+        #hash of each whole row already counted -> how many times it was counted,
+        #so overlapping updates don't double count
+        self._seen = pd.Series(dtype="int64")
+
+    def update(self, frame):
+        """Adds attendance rows to the totals and returns self
+
+        Rows that were already added before are skipped, so it's safe to pass
+        overlapping downloads (e.g. the last 2 weeks every week). Rows are
+        matched on every column, so different records that share a uid, date
+        and event name (e.g. a different eid) are all counted. Identical rows
+        inside one frame are all counted too; only what an earlier update
+        already had is skipped.
+        """
+        #hash every column, in a fixed order, to identify each record
+        all_columns = frame[sorted(frame.columns, key=str)]
+        hashes = pd.Series(pd.util.hash_pandas_object(all_columns, index=False).values)
+        #the nth copy of a row is new if fewer than n copies were counted before
+        copy_number = hashes.groupby(hashes).cumcount()
+        already_counted = hashes.map(self._seen).fillna(0).astype("int64")
+        new = (copy_number >= already_counted).values.copy()
+
+        key_columns = [self.uid_column, self.date_column]
+        has_events = self.event_column in frame.columns
+        if has_events:
+            key_columns.append(self.event_column)
+        rows = frame[key_columns].copy()
+        rows[self.date_column] = pd.to_datetime(rows[self.date_column],
+                                                errors="coerce")
+        new &= rows[self.date_column].notna().values
+        rows = rows[new]
+        if rows.empty:
+            return self
+        new_counts = hashes[new].value_counts()
+        self._seen = self._seen.add(new_counts, fill_value=0).astype("int64")
+
+        uids = rows[self.uid_column]
+        dates = rows[self.date_column]
+        weekly = rows.groupby([uids.values, _week_start(dates).values]).size()
+        self.weekly = self.weekly.add(weekly, fill_value=0).astype("int64")
+
+        last = dates.groupby(uids.values).max()
+        self.last_dates = pd.concat([self.last_dates, last]).groupby(level=0).max()
+
+        if has_events:
+            events = rows.groupby([rows[self.event_column].values,
+                                   uids.values]).size()
+            self.event_people = (self.event_people.add(events, fill_value=0)
+                                 .astype("int64"))
+        return self
+
+    def counts(self, freq="W"):
+        """Returns a uid x period DataFrame of how many events each person attended
+
+        `freq` is any pandas period frequency, e.g. "W", "M", "Q", "Y".
+        Weeks are assigned to the period their Sunday falls in.
+        """
+        if self.weekly.empty:
+            return pd.DataFrame()
+        uids = self.weekly.index.get_level_values(0)
+        weeks = pd.DatetimeIndex(self.weekly.index.get_level_values(1))
+        if freq == "W":
+            periods = weeks
+        else:
+            periods = weeks.to_period(freq)
+        return self.weekly.groupby([uids, periods]).sum().unstack(fill_value=0)
+
+    def last_seen(self):
+        """Returns a Series of uid -> last date attended
+        """
+        return self.last_dates.copy()
+
+    def rolling_participation(self, window=4, as_of=None):
+        """Returns a uid x week DataFrame of the fraction of the last `window`
+        weeks each person attended. The first weeks use a shorter window
+        """
+        matrix = _presence_matrix(self.weekly, as_of)
+        if matrix.empty:
+            return matrix
+        present = (matrix.values > 0).astype(np.int32)
+        running = np.cumsum(present, axis=1)
+        shifted = np.zeros_like(running)
+        shifted[:, window:] = running[:, :-window]
+        weeks_in_window = np.minimum(np.arange(1, present.shape[1] + 1), window)
+        fraction = (running - shifted) / weeks_in_window
+        return pd.DataFrame(fraction, index=matrix.index, columns=matrix.columns)
+
+    def streaks(self, as_of=None):
+        """Returns a DataFrame with each person's current and longest streak of
+        consecutive weeks attended
+        """
+        matrix = _presence_matrix(self.weekly, as_of)
+        if matrix.empty:
+            return pd.DataFrame(columns=["current", "longest"])
+        present = matrix.values > 0
+        n_weeks = present.shape[1]
+
+        #current streak: how far back from the last week until the first miss
+        reverse = present[:, ::-1]
+        current = np.where(reverse.all(axis=1), n_weeks, np.argmin(reverse, axis=1))
+
+        #longest streak: running count that resets to zero at every miss
+        running = np.cumsum(present, axis=1)
+        reset = np.maximum.accumulate(np.where(present, 0, running), axis=1)
+        longest = (running - reset).max(axis=1)
+
+        return pd.DataFrame({"current": current, "longest": longest},
+                            index=matrix.index)
+
+    def lapsed_members(self, weeks=8, as_of=None, min_visits=2):
+        """Returns a DataFrame of people who attended at least `min_visits` times
+        but not in the last `weeks` weeks, sorted by who has been gone longest
+        """
+        if as_of is None:
+            as_of = self.last_dates.max()
+        as_of = pd.Timestamp(as_of)
+        visits = self.weekly.groupby(level=0).sum()
+        summary = pd.DataFrame({"visits": visits, "last_seen": self.last_dates})
+        cutoff = as_of - pd.Timedelta(weeks=weeks)
+        lapsed = summary[(summary["visits"] >= min_visits) &
+                         (summary["last_seen"] < cutoff)].copy()
+        lapsed["weeks_absent"] = ((as_of - lapsed["last_seen"]).dt.days // 7)
+        return lapsed.sort_values("last_seen")
+
+    def event_totals(self):
+        """Returns a DataFrame of each event's total attendance and the number
+        of different people who came
+        """
+        if self.event_people.empty:
+            return pd.DataFrame(columns=["attendance", "people"])
+        by_event = self.event_people.groupby(level=0)
+        totals = pd.DataFrame({"attendance": by_event.sum(),
+                               "people": by_event.size()})
+        return totals.sort_values("attendance", ascending=False)
+
+
+def attendance_counts(frame, freq="W", **columns):
+    """Returns a uid x period DataFrame of events attended. See `AttendanceStats.counts`
+    """
+    return AttendanceStats(**columns).update(frame).counts(freq)
+
+def last_seen(frame, **columns):
+    """Returns a Series of uid -> last date attended
+    """
+    return AttendanceStats(**columns).update(frame).last_seen()
+
+def rolling_participation(frame, window=4, as_of=None, **columns):
+    """Returns the fraction of the last `window` weeks each person attended.
+    See `AttendanceStats.rolling_participation`
+    """
+    return AttendanceStats(**columns).update(frame).rolling_participation(window, as_of)
+
+def attendance_streaks(frame, as_of=None, **columns):
+    """Returns each person's current and longest weekly streak
+    """
+    return AttendanceStats(**columns).update(frame).streaks(as_of)
+
+def lapsed_members(frame, weeks=8, as_of=None, min_visits=2, **columns):
+    """Returns the people who used to attend but haven't in `weeks` weeks.
+    See `AttendanceStats.lapsed_members`
+    """
+    stats = AttendanceStats(**columns).update(frame)
+    return stats.lapsed_members(weeks, as_of, min_visits)
+
+def event_totals(frame, **columns):
+    """Returns each event's total attendance and number of different people
+    """
+    return AttendanceStats(**columns).update(frame).event_totals()
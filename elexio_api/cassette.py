@@ -0,0 +1,244 @@
+"""
+Record and replay every request made to Elexio.
+
+A cassette is a gzipped file with one JSON line per request (url, parameters,
+status, headers, body and how long it took). Text bodies like the JSON from
+Elexio are stored as they are so gzip can compress them well, only binary
+bodies like PDFs are base64 encoded. Recording a real crawl and
+replaying it later lets you rerun and profile it offline:
+
+    with use_cassette("crawl.jsonl.gz", mode="record"):
+        get_all_attendance(session_id, write=False)
+
+    with use_cassette("crawl.jsonl.gz", mode="replay", realtime=True):
+        get_all_attendance("replay", write=False)
+
+Login data is never written to the cassette, and session ids are left out
+of recorded parameters and replaced with a placeholder in recorded response
+bodies (e.g. the login response), so replaying a login returns the placeholder.
+"""
+import base64
+import collections
+import contextlib
+import datetime
+import gzip
+import json
+import time
+
+import requests
+
+from .tools import set_transport
+
+
+__all__ = ["Cassette",
+           "CassetteError",
+           "use_cassette"]
+
+
+CASSETTE_VERSION = 2
+
+#versions load() can read. Version 1 base64 encoded every body
+READABLE_VERSIONS = (1, 2)
+
+#parameters left out of the cassette and ignored when matching requests
+IGNORED_PARAMETERS = ("session_id",)
+
+#written instead of real session ids in recorded response bodies
+SESSION_PLACEHOLDER = "recorded-session-id"
+
+
+class CassetteError(Exception):
+    """Raised when a replayed request isn't in the cassette"""
+
+
+class ReplayResponse:
+    """The parts of `requests.Response` that elexio_api uses, built from a
+    recorded interaction
+    """
+
+    def __init__(self, interaction):
+        self.url = interaction["url"]
+        self.status_code = interaction["status"]
+        self.headers = requests.structures.CaseInsensitiveDict(interaction["headers"])
+        self.content = _decode_body(interaction)
+        self.elapsed = datetime.timedelta(seconds=interaction["elapsed"])
+        self.reason = interaction.get("reason", "")
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8", errors="replace")
+
+    def json(self, **kwargs):
+        return json.loads(self.text, **kwargs)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            message = f"{self.status_code} Error: {self.reason} for url: {self.url}"
+            raise requests.exceptions.HTTPError(message, response=self)
+
+
+def _request_key(method, url, params):
+    """Helper function to get the key a request is matched on
+    """
+    params = params or {}
+    kept = sorted((str(key), str(value)) for key, value in params.items()
+                  if key not in IGNORED_PARAMETERS)
+    return json.dumps([method, url, kept])
+
+
+def _redact_body(content):
+    """Helper function to replace the session id in a JSON response body like
+    the one from /user/login with a placeholder. Other bodies are unchanged
+    """
+    try:
+        body = json.loads(content.decode("utf-8"))
+    except (UnicodeDecodeError, ValueError):
+        return content
+    data = body.get("data") if isinstance(body, dict) else None
+    if not isinstance(data, dict) or "session_id" not in data:
+        return content
+    data["session_id"] = SESSION_PLACEHOLDER
+    return json.dumps(body).encode("utf-8")
+
+
+def _encode_body(content):
+    """Helper function to get the body and how it's stored for an interaction.
+    UTF-8 text is kept as a string, anything else is base64 encoded
+    """
+    try:
+        return content.decode("utf-8"), "text"
+    except UnicodeDecodeError:
+        return base64.b64encode(content).decode("ascii"), "base64"
+
+
+def _decode_body(interaction):
+    """Helper function to get the bytes of a recorded body back
+    """
+    if interaction.get("body_encoding", "base64") == "text":
+        return interaction["body"].encode("utf-8")
+    return base64.b64decode(interaction["body"])
+
+
+class Cassette:
+    """Records requests to a file or replays them from it
+
+    Use it through `use_cassette`, or pass it to `set_transport`.
+
+    Parameters
+    ----------
+    path : `str`
+        Cassette file. Written as gzipped JSON lines
+    mode : `str`, optional (default: "replay")
+        "record" sends requests to Elexio and saves them, "replay" only reads
+        from the cassette
+    realtime : `bool`, optional (default: False)
+        When replaying, sleep for as long as the original request took.
+        False replays as fast as possible
+    transport : optional (default: `requests`)
+        What to send requests through when recording
+
+    """
+
+    def __init__(self, path, mode="replay", realtime=False, transport=requests):
+        if mode not in ("record", "replay"):
+            raise ValueError(f"mode must be 'record' or 'replay', not {mode!r}")
+        self.path = path
+        self.mode = mode
+        self.realtime = realtime
+        self.transport = transport
+        self.interactions = []
+        self._queues = {}
+        if mode == "replay":
+            self.load()
+
+    def load(self):
+        """Reads the interactions from the cassette file
+        """
+        with gzip.open(self.path, "rt", encoding="utf-8") as cassette_file:
+            header = json.loads(cassette_file.readline())
+            if header.get("version") not in READABLE_VERSIONS:
+                raise CassetteError(f"Unknown cassette version {header.get('version')}")
+            self.interactions = [json.loads(line) for line in cassette_file]
+        self._queues = collections.defaultdict(collections.deque)
+        for interaction in self.interactions:
+            self._queues[interaction["key"]].append(interaction)
+
+    def save(self):
+        """Writes the recorded interactions to the cassette file
+        """
+        with gzip.open(self.path, "wt", encoding="utf-8") as cassette_file:
+            cassette_file.write(json.dumps({"version": CASSETTE_VERSION}) + "\n")
+            for interaction in self.interactions:
+                cassette_file.write(json.dumps(interaction, separators=(",", ":")) + "\n")
+
+    def get(self, url, params=None, **kwargs):
+        return self._send("GET", url, params, kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        #login data (username and password) is never part of the key or the file
+        return self._send("POST", url, None, dict(kwargs, data=data))
+
+    def _send(self, method, url, params, kwargs):
+        key = _request_key(method, url, params)
+        if self.mode == "replay":
+            return self._replay(key)
+
+        start = time.perf_counter()
+        if method == "GET":
+            response = self.transport.get(url, params=params, **kwargs)
+        else:
+            response = self.transport.post(url, **kwargs)
+        elapsed = time.perf_counter() - start
+
+        body, body_encoding = _encode_body(_redact_body(response.content))
+        recorded_params = {k: str(v) for k, v in (params or {}).items()
+                           if k not in IGNORED_PARAMETERS}
+        self.interactions.append({
+            "key": key,
+            "method": method,
+            "url": url,
+            "params": recorded_params,
+            "status": response.status_code,
+            "reason": getattr(response, "reason", "") or "",
+            "headers": {"Content-Type": response.headers.get("Content-Type", "")},
+            "body": body,
+            "body_encoding": body_encoding,
+            "elapsed": elapsed,
+        })
+        return response
+
+    def _replay(self, key):
+        queue = self._queues.get(key)
+        if not queue:
+            raise CassetteError(f"No recorded response for {key}")
+        #repeated requests get the recorded responses in order, the last one
+        #is reused if the crawl asks more times than were recorded
+        interaction = queue.popleft() if len(queue) > 1 else queue[0]
+        if self.realtime:
+            time.sleep(interaction["elapsed"])
+        return ReplayResponse(interaction)
+
+    def summary(self):
+        """Returns the number of requests, bytes received and the recorded time
+        spent waiting on Elexio, for comparing crawls
+        """
+        return {"requests": len(self.interactions),
+                "bytes": sum(len(_decode_body(i)) for i in self.interactions),
+                "elapsed": sum(i["elapsed"] for i in self.interactions)}
+
+
+@contextlib.contextmanager
+def use_cassette(path, mode="replay", realtime=False, transport=requests):
+    """Sends every Elexio request in the `with` block through a `Cassette`
+
+    Recorded cassettes are saved when the block exits, even if it raised, so
+    a failing crawl can still be replayed up to the failure.
+    """
+    cassette = Cassette(path, mode=mode, realtime=realtime, transport=transport)
+    previous = set_transport(cassette)
+    try:
+        yield cassette
+    finally:
+        set_transport(previous)
+        if mode == "record":
+            cassette.save()
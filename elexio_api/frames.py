@@ -0,0 +1,134 @@
+"""
+Functions to shrink the DataFrames built from Elexio data.
+
+The frames returned by `download_all` and the crawlers store every value as a
+separate python object, so columns like gender, status or group names repeat
+the same string on every row. `optimize_frame` converts those columns to
+compact dtypes.
+"""
+import pandas as pd
+
+
+__all__ = ["optimize_frame",
+           "frame_memory",
+           "memory_report"]
+
+
+def _is_string_column(column):
+    """Helper function to check that an object column only holds strings
+    """
+    values = column.dropna()
+    if len(values) == 0:
+        return False
+    return values.map(type).eq(str).all()
+
+
+def _downcast_numeric(column):
+    """Helper function to downcast an int or float column to the smallest dtype
+    """
+    if pd.api.types.is_bool_dtype(column):
+        return column
+    if pd.api.types.is_integer_dtype(column):
+        if len(column) and column.min() >= 0:
+            return pd.to_numeric(column, downcast="unsigned")
+        return pd.to_numeric(column, downcast="integer")
+    if pd.api.types.is_float_dtype(column):
+        return pd.to_numeric(column, downcast="float")
+    return column
+
+
+def _arrow_string_dtype():
+    """Helper function to get the arrow backed string dtype, if pyarrow is installed
+    """
+    message = ("use_arrow=True needs pyarrow (`pip install elexio_api[arrow]`) "
+               "and pandas 1.3 or newer")
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        raise ImportError(message)
+    if not hasattr(pd, "StringDtype"):
+        raise ImportError(message)
+    try:
+        return pd.StringDtype("pyarrow")
+    except (TypeError, ValueError):
+        #pandas 1.0 to 1.2 has StringDtype but no pyarrow storage
+        raise ImportError(message)
+
+
+def optimize_frame(data_frame, date_columns=(), category_threshold=0.5,
+                   use_arrow=False):
+    """Returns a copy of the DataFrame using memory efficient dtypes
+
+    Parameters
+    ----------
+    data_frame : `pandas.DataFrame`
+        Frame returned by `download_all`, `get_all_users`, `get_all_attendance` etc
+    date_columns : `list`, optional
+        Columns to parse as dates. Use the date fields from `_get_metadata`.
+        Values that can't be parsed (Elexio sends `""` for no date) become NaT
+    category_threshold : `float`, optional (default: 0.5)
+        String columns where the number of unique values divided by the
+        number of rows is at or below this are stored as categoricals
+    use_arrow : `bool`, optional (default: False)
+        Store the remaining string columns as arrow backed strings. Needs pyarrow
+
+    Returns
+    -------
+    `pandas.DataFrame`
+
+    """
+    string_dtype = _arrow_string_dtype() if use_arrow else None
+    n_rows = len(data_frame)
+
+    #work on columns by position since renamed meta fields can repeat names
+    columns = []
+    for position, name in enumerate(data_frame.columns):
+        column = data_frame.iloc[:, position]
+        if name in date_columns:
+            #parse every unique date string once instead of once per row
+            column = pd.to_datetime(column.where(column != ""),
+                                    errors="coerce", cache=True)
+        elif pd.api.types.is_numeric_dtype(column):
+            column = _downcast_numeric(column)
+        elif ((column.dtype == object or pd.api.types.is_string_dtype(column))
+              and _is_string_column(column)):
+            n_unique = column.nunique(dropna=True)
+            if n_rows and n_unique / n_rows <= category_threshold:
+                column = column.astype("category")
+            elif string_dtype is not None:
+                column = column.astype(string_dtype)
+        columns.append(column)
+
+    if not columns:
+        return data_frame.copy()
+    optimized = pd.concat(columns, axis=1)
+    optimized.columns = data_frame.columns
+    return optimized
+
+
+def frame_memory(data_frame):
+    """Returns the number of bytes used by a DataFrame, including python strings
+    """
+    return int(data_frame.memory_usage(deep=True).sum())
+
+
+def memory_report(original, optimized):
+    """Compares the memory used by two frames
+
+    Parameters
+    ----------
+    original : `pandas.DataFrame`
+    optimized : `pandas.DataFrame`
+        Usually the result of `optimize_frame(original)`
+
+    Returns
+    -------
+    `dict`
+        `{"before": bytes, "after": bytes, "saved": bytes, "ratio": after/before}`
+
+    """
+    before = frame_memory(original)
+    after = frame_memory(optimized)
+    ratio = after / before if before else 1.0
+    return {"before": before, "after": after, "saved": before - after,
+            "ratio": ratio}
@@ -37,22 +37,80 @@ def extract_image(pdf_bytes):
     jpg_bytes = pdf_bytes[start_byte:end_byte]
     return jpg_bytes
 
-def process_folder(input_folder, output_folder):
-    
+def process_folder(input_folder, output_folder, store=None):
+    """
+    Extracts the image from every pdf in a folder and saves them as jpgs
+
+    Parameters
+    ----------
+    input_folder : str
+        Folder with the pdfs
+    output_folder : str
+        Folder to save {name}.jpg in. Can be None when using a store
+    store : ContentStore, optional
+        If given, the jpgs are put in the store and a jpg is only written to 
+        output_folder when it changed or isn't there yet
+    """
     files = os.listdir(input_folder)
     pdfs = [file for file in files if file.endswith(".pdf")]
     
     for pdf in pdfs:
-        jpg_filepath = os.path.join(output_folder, pdf[:-4] + ".jpg")
         pdf_filepath = os.path.join(input_folder, pdf)
         with open(pdf_filepath, "rb") as pdf_file:
             pdf_bytes = pdf_file.read()
         jpg_bytes = extract_image(pdf_bytes)
         if jpg_bytes is not None:
-            with open(jpg_filepath, "wb") as jpg_file:
-                jpg_file.write(jpg_bytes)
+            _save_jpg(pdf[:-4], jpg_bytes, output_folder, store)
     return
 
+def process_store(pdf_store, jpg_store, keys=None, output_folder=None):
+    """
+    Extracts the image from pdfs in a ContentStore into another ContentStore
+
+    Parameters
+    ----------
+    pdf_store : ContentStore
+        Store the pdfs were downloaded into with get_pdf_of_user
+    jpg_store : ContentStore
+        Store to put the jpgs in
+    keys : list, optional
+        Only process these keys. Use pdf_store.changed or 
+        pdf_store.changed_since(old_manifest) to only look at new pdfs. 
+        Defaults to every pdf in the store
+    output_folder : str, optional
+        Also write {key}.jpg here when a jpg changes
+
+    Returns
+    -------
+    changed : list
+        Keys whose jpg changed
+    """
+    if keys is None:
+        keys = list(pdf_store.manifest)
+    changed = []
+    for key in keys:
+        pdf_bytes = pdf_store.get(key)
+        if pdf_bytes is None:
+            continue
+        jpg_bytes = extract_image(pdf_bytes)
+        if jpg_bytes is not None and _save_jpg(key, jpg_bytes, output_folder, jpg_store):
+            changed.append(key)
+    return changed
+
+def _save_jpg(name, jpg_bytes, output_folder, store):
+    """Writes one jpg, skipping the write when the store says it hasn't changed
+    """
+    jpg_filepath = None
+    if output_folder is not None:
+        jpg_filepath = os.path.join(output_folder, str(name) + ".jpg")
+    changed = True
+    if store is not None:
+        changed = store.put(name, jpg_bytes)
+    if jpg_filepath is not None and (changed or not os.path.exists(jpg_filepath)):
+        with open(jpg_filepath, "wb") as jpg_file:
+            jpg_file.write(jpg_bytes)
+    return changed
+
 
 
 if __name__ == "__main__":
@@ -0,0 +1,204 @@
+"""
+Keep a local attendance history and only download what's new.
+
+Past weeks of attendance don't change, so instead of downloading the last 50
+weeks for everyone on every run, `update_attendance_history` remembers the
+newest event stored for each person (their watermark), asks Elexio for small
+windows of their newest attendance and stops as soon as it reaches events it
+already has. A weekly run then fetches about one week per person.
+"""
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+from . import tools
+from .attendance import DATE_COLUMN, UID_COLUMN
+
+
+__all__ = ["AttendanceHistory",
+           "update_attendance_history"]
+
+
+HISTORY_NAME = "attendance_history.pkl"
+WATERMARKS_NAME = "watermarks.json"
+
+
+def _item_key(item):
+    """Helper function to identify an attendance item by its contents
+    """
+    item_json = json.dumps(item, sort_keys=True, default=str)
+    return hashlib.sha1(item_json.encode("utf-8")).hexdigest()
+
+
+def _item_date(item, date_column):
+    """Helper function to get an item's date as a 'YYYY-MM-DD' string, or None
+    """
+    date = pd.to_datetime(item.get(date_column), errors="coerce")
+    if pd.isnull(date):
+        return None
+    return date.strftime("%Y-%m-%d")
+
+
+class AttendanceHistory:
+    """Attendance stored in a folder with a watermark for every person
+
+    The watermark of a uid is the date of the newest event stored for them
+    and the keys of the events stored on that date, so two services on the
+    same day are told apart. Events without a date can't be placed before or
+    after it, so the keys of every one of those are kept too.
+
+    Parameters
+    ----------
+    folder : `str`
+        Where the history is kept. Created if it doesn't exist
+    date_column : `str`, optional (default: "date")
+        The date field of the attendance items
+
+    """
+
+    def __init__(self, folder, date_column=DATE_COLUMN):
+        self.folder = folder
+        self.date_column = date_column
+        os.makedirs(folder, exist_ok=True)
+        self.history_path = os.path.join(folder, HISTORY_NAME)
+        self.watermarks_path = os.path.join(folder, WATERMARKS_NAME)
+        if os.path.exists(self.watermarks_path):
+            with open(self.watermarks_path, "r") as watermarks_file:
+                self.watermarks = json.load(watermarks_file)
+        else:
+            self.watermarks = {}
+        self._frames = []
+        if os.path.exists(self.history_path):
+            self._frames.append(pd.read_pickle(self.history_path))
+
+    def frame(self):
+        """Returns every stored attendance row as one DataFrame
+        """
+        if not self._frames:
+            return pd.DataFrame()
+        if len(self._frames) > 1:
+            self._frames = [pd.concat(self._frames, ignore_index=True, sort=False)]
+        return self._frames[0]
+
+    def is_known(self, uid, item):
+        """True if the item is at or behind the uid's watermark
+        """
+        watermark = self.watermarks.get(str(uid))
+        if watermark is None:
+            return False
+        date = _item_date(item, self.date_column)
+        if date is None:
+            return _item_key(item) in watermark.get("undated", ())
+        if date < watermark["date"]:
+            return True
+        return _item_key(item) in watermark["keys"]
+
+    def append(self, uid, items):
+        """Adds new items for a uid, moves its watermark forward and returns
+        the new rows as a DataFrame
+        """
+        if not items:
+            return pd.DataFrame()
+        new_df = pd.DataFrame(items)
+        if UID_COLUMN not in new_df.columns:
+            new_df.insert(0, UID_COLUMN, uid)
+        self._frames.append(new_df)
+
+        watermark = self.watermarks.get(str(uid), {"date": "", "keys": []})
+        undated = watermark.get("undated", [])
+        for item in items:
+            date = _item_date(item, self.date_column)
+            if date is None:
+                undated.append(_item_key(item))
+                continue
+            if date < watermark["date"]:
+                continue
+            if date > watermark["date"]:
+                watermark = {"date": date, "keys": []}
+            watermark["keys"].append(_item_key(item))
+        if undated:
+            watermark["undated"] = undated
+        self.watermarks[str(uid)] = watermark
+        return new_df
+
+    def save(self):
+        """Writes the history and the watermarks
+        """
+        history = self.frame()
+        temp_path = self.history_path + ".tmp"
+        history.to_pickle(temp_path, compression=None)
+        os.replace(temp_path, self.history_path)
+        temp_path = self.watermarks_path + ".tmp"
+        with open(temp_path, "w") as watermarks_file:
+            json.dump(self.watermarks, watermarks_file)
+        os.replace(temp_path, self.watermarks_path)
+
+
+def _fetch_new_items(session_id, uid, history, page_size, max_weeks):
+    """Helper function to get a uid's items newer than its watermark, newest first
+    """
+    if str(uid) not in history.watermarks:
+        #nothing stored yet, get the whole window at once
+        return tools._get_attendance_items(session_id, uid, 0, max_weeks)
+
+    new_items = []
+    start = 0
+    while start < max_weeks:
+        count = min(page_size, max_weeks - start)
+        items = tools._get_attendance_items(session_id, uid, start, count)
+        for item in items:
+            if history.is_known(uid, item):
+                #an undated event could be anywhere in the list, so only
+                #a dated one means everything after it is stored already
+                if _item_date(item, history.date_column) is None:
+                    continue
+                return new_items
+            new_items.append(item)
+        if len(items) < count:
+            break
+        start += count
+    return new_items
+
+
+def update_attendance_history(session_id, folder, uids=None, page_size=4,
+                              max_weeks=50, date_column=DATE_COLUMN):
+    """Downloads only the attendance that isn't in the local history yet
+
+    Parameters
+    ----------
+    session_id : `str`
+        Found using the `get_session_id()` method
+    folder : `str`
+        Folder with the `AttendanceHistory`
+    uids : `list`, optional
+        People to update. Defaults to everyone from `download_all`
+    page_size : `int`, optional (default: 4)
+        Number of events asked for at a time for people who have a watermark
+    max_weeks : `int`, optional (default: 50)
+        Furthest back to look. People without a watermark get this many
+        events in one request, like `get_all_attendance`
+    date_column : `str`, optional (default: "date")
+        The date field of the attendance items, passed to `AttendanceHistory`
+
+    Returns
+    -------
+    `pandas.DataFrame`
+        Only the new rows, e.g. for `AttendanceStats.update`. The full
+        history is `AttendanceHistory(folder).frame()`
+
+    """
+    history = AttendanceHistory(folder, date_column=date_column)
+    if uids is None:
+        uids = tools.download_all(session_id, write=False, fields=["uid"])['uid']
+    new_frames = []
+    print("Grabbing new attendance of every user...")
+    for uid in uids:
+        new_items = _fetch_new_items(session_id, uid, history, page_size, max_weeks)
+        if new_items:
+            new_frames.append(history.append(uid, new_items))
+    history.save()
+    if not new_frames:
+        return pd.DataFrame()
+    return pd.concat(new_frames, ignore_index=True, sort=False)
@@ -0,0 +1,304 @@
+"""
+A search index over the people list for quick name, email and phone lookups.
+
+Instead of calling `download_all` and scanning the frame for every lookup,
+build a `PeopleIndex` once, save it, and load it again in a fraction of a
+second:
+
+    index = PeopleIndex.from_elexio(session_id)
+    index.save("people.idx")
+
+    index = PeopleIndex.load("people.idx")
+    index.prefix("bo pet")        # first/last names starting with bo and pet
+    index.search("jonhson")       # typo tolerant
+    index.update_from_elexio(session_id)   # only re-indexes who changed
+"""
+import bisect
+import hashlib
+import json
+import pickle
+import re
+import unicodedata
+
+import pandas as pd
+
+from . import tools
+
+
+__all__ = ["PeopleIndex",
+           "normalize_text"]
+
+
+INDEX_VERSION = 2
+
+#column names containing these words are indexed when no fields are given
+DEFAULT_FIELD_WORDS = ("name", "email", "phone")
+
+
+def normalize_text(text):
+    """Case folds, strips accents and splits into words. "José O'Neil" -> ['jose', 'o', 'neil']
+    """
+    text = unicodedata.normalize("NFKD", str(text))
+    text = "".join(char for char in text if not unicodedata.combining(char))
+    return re.findall(r"[^\W_]+", text.casefold())
+
+
+def _phone_tokens(text):
+    """Helper function to index phone numbers by their digits only, so
+    "(555) 123-4567" is found by "5551234567" and "555-123"
+    """
+    digits = re.sub(r"\D", "", str(text))
+    return [digits] if digits else []
+
+
+def _missing(value):
+    """Helper function to tell if a field is empty. DataFrame records have
+    NaN for missing values, which would otherwise be indexed as "nan"
+    """
+    return value is None or value == "" or (pd.api.types.is_scalar(value) and
+                                           pd.isnull(value))
+
+
+def _trigrams(token):
+    """Helper function to get the 3 letter pieces of a word, with its start
+    and end marked so whole words score higher
+    """
+    padded = f"^{token}$"
+    return {padded[i:i + 3] for i in range(max(1, len(padded) - 2))}
+
+
+class PeopleIndex:
+    """Prefix and fuzzy search over people records
+
+    Parameters
+    ----------
+    fields : `list`, optional
+        Record keys to index. Defaults to every key with "name", "email" or
+        "phone" in it, found from the first records indexed
+    uid_field : `str`, optional (default: "uid")
+
+    """
+
+    def __init__(self, fields=None, uid_field="uid"):
+        self.fields = list(fields) if fields is not None else None
+        self.uid_field = uid_field
+        #uid -> the indexed fields of the record
+        self.records = {}
+        self._digests = {}
+        self._tokens = {}
+        #word -> uids, and the sorted words for prefix lookups
+        self._words = {}
+        self._sorted_words = None
+        #trigram -> uids, for fuzzy lookups
+        self._grams = {}
+
+    def __len__(self):
+        return len(self.records)
+
+    def __contains__(self, uid):
+        return uid in self.records
+
+    @classmethod
+    def from_records(cls, records, **kwargs):
+        index = cls(**kwargs)
+        index.update(records)
+        return index
+
+    @classmethod
+    def from_elexio(cls, session_id, **kwargs):
+        """Builds the index straight from /people/all, without making a DataFrame
+        """
+        index = cls(**kwargs)
+        index.update_from_elexio(session_id)
+        return index
+
+    def update_from_elexio(self, session_id):
+        """Downloads /people/all and updates the index. See `update`
+        """
+        people_data = tools._request_get_data("/people/all", {"session_id": session_id})
+        return self.update(tools._parse_names(people_data))
+
+    def _pick_fields(self, record):
+        return [key for key in record
+                if any(word in key.lower() for word in DEFAULT_FIELD_WORDS)]
+
+    def _record_tokens(self, record):
+        tokens = set()
+        for field in self.fields:
+            value = record.get(field)
+            if _missing(value):
+                continue
+            if "phone" in field.lower():
+                tokens.update(_phone_tokens(value))
+            else:
+                tokens.update(normalize_text(value))
+        return tokens
+
+    def _add(self, uid, tokens):
+        self._tokens[uid] = tokens
+        for token in tokens:
+            if token not in self._words:
+                self._sorted_words = None
+            self._words.setdefault(token, set()).add(uid)
+            for gram in _trigrams(token):
+                self._grams.setdefault(gram, set()).add(uid)
+
+    def _remove(self, uid):
+        for token in self._tokens.pop(uid, ()):
+            uids = self._words[token]
+            uids.discard(uid)
+            if not uids:
+                del self._words[token]
+                self._sorted_words = None
+            for gram in _trigrams(token):
+                gram_uids = self._grams.get(gram)
+                if gram_uids is not None:
+                    gram_uids.discard(uid)
+                    if not gram_uids:
+                        del self._grams[gram]
+        self.records.pop(uid, None)
+        self._digests.pop(uid, None)
+
+    def update(self, records, remove_missing=True):
+        """Adds new people, re-indexes people whose fields changed and, with
+        `remove_missing`, drops people that aren't in `records` anymore
+
+        Parameters
+        ----------
+        records : `list` of `dict` or `pandas.DataFrame`
+        remove_missing : `bool`, optional (default: True)
+            Set to False when `records` is only some of the people
+
+        Returns
+        -------
+        `dict`
+            {"added": n, "changed": n, "removed": n}
+
+        """
+        if hasattr(records, "to_dict"):
+            records = records.to_dict("records")
+        counts = {"added": 0, "changed": 0, "removed": 0}
+        seen = set()
+        for record in records:
+            if self.fields is None:
+                self.fields = self._pick_fields(record)
+            uid = record[self.uid_field]
+            seen.add(uid)
+            kept = {field: None if _missing(record.get(field)) else record.get(field)
+                    for field in self.fields}
+            digest = hashlib.sha1(json.dumps(kept, sort_keys=True, default=str)
+                                  .encode("utf-8")).hexdigest()
+            if self._digests.get(uid) == digest:
+                continue
+            counts["changed" if uid in self.records else "added"] += 1
+            self._remove(uid)
+            self.records[uid] = kept
+            self._digests[uid] = digest
+            self._add(uid, self._record_tokens(kept))
+        if remove_missing:
+            for uid in set(self.records) - seen:
+                self._remove(uid)
+                counts["removed"] += 1
+        return counts
+
+    def _prefix_uids(self, token):
+        if self._sorted_words is None:
+            self._sorted_words = sorted(self._words)
+        uids = set()
+        position = bisect.bisect_left(self._sorted_words, token)
+        while (position < len(self._sorted_words) and
+               self._sorted_words[position].startswith(token)):
+            uids |= self._words[self._sorted_words[position]]
+            position += 1
+        return uids
+
+    def _query_tokens(self, query):
+        tokens = normalize_text(query)
+        digits = _phone_tokens(query)
+        #a query that's mostly a phone number is searched as one number
+        if digits and len(digits[0]) >= 3 and len(digits[0]) * 2 >= len(query.strip()):
+            tokens = digits
+        return tokens
+
+    def _results(self, scores, limit):
+        ranked = sorted(scores.items(), key=lambda item: (-item[1], str(item[0])))
+        results = []
+        for uid, score in ranked[:limit]:
+            result = {self.uid_field: uid, "score": round(score, 3)}
+            result.update(self.records[uid])
+            results.append(result)
+        return results
+
+    def _prefix_matches(self, tokens):
+        matches = None
+        for token in tokens:
+            uids = self._prefix_uids(token)
+            matches = uids if matches is None else matches & uids
+            if not matches:
+                return set()
+        return matches or set()
+
+    def prefix(self, query, limit=20):
+        """Finds people with a word starting with every word of the query
+
+        Returns
+        -------
+        `list` of `dict`
+            The indexed fields of each match plus uid and score
+
+        """
+        matches = self._prefix_matches(self._query_tokens(query))
+        return self._results({uid: 1.0 for uid in matches}, limit)
+
+    def search(self, query, limit=10, min_score=0.3):
+        """Typo tolerant search. Scores are the share of the query's 3 letter
+        pieces found in the person's words, plus 1 for an exact prefix match
+
+        Returns
+        -------
+        `list` of `dict`
+            Best matches first
+
+        """
+        tokens = self._query_tokens(query)
+        if not tokens:
+            return []
+        query_grams = set()
+        for token in tokens:
+            query_grams |= _trigrams(token)
+        hits = {}
+        for gram in query_grams:
+            for uid in self._grams.get(gram, ()):
+                hits[uid] = hits.get(uid, 0) + 1
+        scores = {uid: count / len(query_grams) for uid, count in hits.items()
+                  if count / len(query_grams) >= min_score}
+        for uid in self._prefix_matches(tokens):
+            if uid in scores:
+                scores[uid] += 1.0
+        return self._results(scores, limit)
+
+    def save(self, path):
+        """Writes the index to a file for `PeopleIndex.load`
+        """
+        state = {"version": INDEX_VERSION, "fields": self.fields,
+                 "uid_field": self.uid_field, "records": self.records,
+                 "digests": self._digests, "tokens": self._tokens,
+                 "words": self._words, "grams": self._grams}
+        with open(path, "wb") as index_file:
+            pickle.dump(state, index_file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    @classmethod
+    def load(cls, path):
+        """Reads an index written by `save`
+        """
+        with open(path, "rb") as index_file:
+            state = pickle.load(index_file)
+        if state.get("version") != INDEX_VERSION:
+            raise ValueError(f"{path} was saved by a different version of PeopleIndex")
+        index = cls(fields=state["fields"], uid_field=state["uid_field"])
+        index.records = state["records"]
+        index._digests = state["digests"]
+        index._tokens = state["tokens"]
+        index._words = state["words"]
+        index._grams = state["grams"]
+        return index
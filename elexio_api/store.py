@@ -0,0 +1,223 @@
+"""
+A content addressed store for downloaded PDFs and extracted photos.
+
+Every file is saved once under the sha256 of its bytes, and a manifest keeps
+track of which hash belongs to which key (usually a uid):
+
+    root/
+        manifest.json          {"1149": "3f5a...", ...}
+        objects/3f/5a...       the bytes
+
+Putting bytes that haven't changed doesn't write anything, and comparing two
+manifests shows which people have a new PDF or photo. Several stores, in
+threads or processes, can share a root: `save()` merges with the manifest
+on disk under a lock file instead of overwriting it.
+"""
+import contextlib
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+__all__ = ["ContentStore"]
+
+
+MANIFEST_NAME = "manifest.json"
+OBJECTS_DIR = "objects"
+TEMP_SUFFIX = ".tmp"
+LOCK_NAME = "manifest.lock"
+
+#a lock file older than this was left behind by a writer that crashed
+STALE_LOCK_SECONDS = 60
+
+
+def _write_atomic(path, data):
+    """Helper function to write bytes to a temporary file and move it into
+    place, so a crash never leaves half a file behind. Every write gets its
+    own temporary file, so threads and processes writing the same path at
+    once don't get in each other's way
+    """
+    temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}{TEMP_SUFFIX}"
+    try:
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+@contextlib.contextmanager
+def _lock_file(path, timeout=30):
+    """Helper function to hold a lock file while the block runs. Works across
+    processes since creating a file with O_EXCL fails if it already exists
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            lock = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            break
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(path) > STALE_LOCK_SECONDS:
+                    os.remove(path)
+                    continue
+            except OSError:
+                #the other writer let go in the meantime
+                continue
+            if time.monotonic() > deadline:
+                raise TimeoutError(f"Waited {timeout} seconds for {path}")
+            time.sleep(0.05)
+    try:
+        yield
+    finally:
+        os.close(lock)
+        os.remove(path)
+
+
+class ContentStore:
+    """Stores bytes by their sha256 hash with a key -> hash manifest
+
+    Parameters
+    ----------
+    root : `str`
+        Folder to keep the store in. Created if it doesn't exist
+
+    Notes
+    -----
+    The manifest is written by `save()`, or when a `with` block exits:
+
+    >>> with ContentStore("pdfs") as store:
+    ...     get_pdf_of_user(session_id, 1149, store=store)
+    >>> store.changed
+    {'1149'}
+
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.objects = os.path.join(root, OBJECTS_DIR)
+        self.manifest_path = os.path.join(root, MANIFEST_NAME)
+        self.lock_path = os.path.join(root, LOCK_NAME)
+        os.makedirs(self.objects, exist_ok=True)
+        self.manifest = self._read_manifest()
+        #keys that were added or changed since the store was opened
+        self.changed = set()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    def __contains__(self, key):
+        return str(key) in self.manifest
+
+    def __len__(self):
+        return len(self.manifest)
+
+    def _read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {}
+        with open(self.manifest_path, "r") as manifest_file:
+            return json.load(manifest_file)
+
+    def _object_path(self, digest):
+        return os.path.join(self.objects, digest[:2], digest[2:])
+
+    def put(self, key, data):
+        """Stores the bytes for a key
+
+        Returns
+        -------
+        `bool`
+            True if the key is new or its bytes changed, False if nothing was written
+
+        """
+        key = str(key)
+        digest = hashlib.sha256(data).hexdigest()
+        if self.manifest.get(key) == digest:
+            return False
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_atomic(path, data)
+        self.manifest[key] = digest
+        self.changed.add(key)
+        return True
+
+    def get(self, key):
+        """Returns the bytes stored for a key, or None if there aren't any
+        """
+        path = self.path(key)
+        if path is None:
+            return None
+        with open(path, "rb") as blob:
+            return blob.read()
+
+    def digest(self, key):
+        """Returns the sha256 hex digest stored for a key, or None
+        """
+        return self.manifest.get(str(key))
+
+    def path(self, key):
+        """Returns the path of the file holding a key's bytes, or None
+        """
+        digest = self.digest(key)
+        if digest is None:
+            return None
+        return self._object_path(digest)
+
+    def changed_since(self, old_manifest):
+        """Returns the keys that are new or different compared to an older manifest
+
+        Parameters
+        ----------
+        old_manifest : `dict` or `str`
+            A manifest dictionary (e.g. a copy of `store.manifest`) or the
+            path to a saved manifest.json
+        """
+        if isinstance(old_manifest, str):
+            with open(old_manifest, "r") as manifest_file:
+                old_manifest = json.load(manifest_file)
+        return [key for key, digest in self.manifest.items()
+                if old_manifest.get(key) != digest]
+
+    def save(self):
+        """Writes the manifest
+
+        Keys saved by other stores sharing the root since this one was opened
+        are kept. Where both changed a key, this store's hash wins. Afterwards
+        `manifest` holds the merged keys
+        """
+        with _lock_file(self.lock_path):
+            merged = self._read_manifest()
+            merged.update({key: self.manifest[key] for key in self.changed})
+            manifest_bytes = json.dumps(merged, sort_keys=True).encode("utf-8")
+            _write_atomic(self.manifest_path, manifest_bytes)
+        self.manifest = merged
+
+    def prune(self):
+        """Deletes stored files that no key points to anymore and returns how many
+
+        Files in the saved manifest or in this store are kept. Files that
+        another store put but hasn't saved yet are not, so only prune when
+        the other writers sharing the root have saved
+        """
+        removed = 0
+        with _lock_file(self.lock_path):
+            in_use = set(self._read_manifest().values())
+            in_use.update(self.manifest.values())
+            for prefix in os.listdir(self.objects):
+                prefix_dir = os.path.join(self.objects, prefix)
+                for rest in os.listdir(prefix_dir):
+                    #skip files another writer is still in the middle of
+                    if rest.endswith(TEMP_SUFFIX):
+                        continue
+                    if prefix + rest not in in_use:
+                        os.remove(os.path.join(prefix_dir, rest))
+                        removed += 1
+        return removed
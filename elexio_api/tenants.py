@@ -0,0 +1,281 @@
+"""
+Talk to many Elexio instances (tenants) from one process.
+
+Each `Tenant` has its own base url, download location, login, connection
+pool, cache and rate limit. While a tenant is activated in a thread, every
+elexio_api function called in that thread uses it instead of the BASEURL and
+DOWNLOAD_LOCATION from config.json.
+
+`TenantScheduler` runs a job for every tenant at once and shares a global
+limit on requests in flight fairly between them, so one big congregation
+can't starve the others:
+
+    tenants = load_tenants("tenants.json")
+    scheduler = TenantScheduler(tenants, max_concurrency=8)
+    results = scheduler.run(lambda tenant: download_all(tenant.session_id, write=False))
+"""
+import collections
+import concurrent.futures
+import contextlib
+import itertools
+import json
+import threading
+import time
+
+import requests
+
+from . import tools
+
+
+__all__ = ["Tenant",
+           "TenantScheduler",
+           "FairBudget",
+           "RateLimiter",
+           "load_tenants"]
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` requests per second with bursts of `burst`
+    """
+
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Blocks until a request is allowed
+        """
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst,
+                                   self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class FairBudget:
+    """A limit on requests in flight shared between tenants
+
+    When a slot frees up it goes to the waiting tenant with the fewest
+    requests in flight, and between equals to whoever has waited longest.
+    """
+
+    def __init__(self, max_concurrency):
+        self.max_concurrency = max_concurrency
+        self.in_flight = collections.Counter()
+        self._waiting = []
+        self._tickets = itertools.count()
+        self._condition = threading.Condition()
+
+    def _next_ticket(self):
+        return min(self._waiting, key=lambda waiter: (self.in_flight[waiter[1]],
+                                                      waiter[0]))
+
+    def acquire(self, name):
+        with self._condition:
+            waiter = (next(self._tickets), name)
+            self._waiting.append(waiter)
+            while (sum(self.in_flight.values()) >= self.max_concurrency or
+                   self._next_ticket() != waiter):
+                self._condition.wait()
+            self._waiting.remove(waiter)
+            self.in_flight[name] += 1
+            #others may be able to go too if there's room
+            self._condition.notify_all()
+
+    def release(self, name):
+        with self._condition:
+            self.in_flight[name] -= 1
+            self._condition.notify_all()
+
+    @contextlib.contextmanager
+    def slot(self, name):
+        self.acquire(name)
+        try:
+            yield
+        finally:
+            self.release(name)
+
+
+class Tenant:
+    """One Elexio instance
+
+    Parameters
+    ----------
+    name : `str`
+        Used to label results
+    base_url : `str`
+        e.g. "https://example.elexiochms.com/api"
+    download_location : `str`, optional (default: "")
+        Where files for this tenant are saved
+    username : `str`, optional
+    password : `str`, optional
+        Used by `login()`. If not given, `get_session_id` prompts for them
+    max_connections : `int`, optional (default: 4)
+        Size of this tenant's connection pool and the most requests it can
+        have in flight at once
+    requests_per_second : `float`, optional
+        Rate limit for this tenant. None means no limit
+    transport : optional
+        Send requests through this instead of the tenant's own
+        `requests.Session`. If not given and a global transport is set with
+        `set_transport` or `use_cassette`, requests go through that instead,
+        so a cassette around a `TenantScheduler` run records every tenant.
+        The tenant's rate limit and budget still apply, but its own
+        connection pool isn't used then. To record one tenant through its
+        own pool, set `tenant.transport = Cassette(path, mode="record",
+        transport=tenant.session)` and call `save()` on the cassette afterwards
+
+    """
+
+    def __init__(self, name, base_url, download_location="", username=None,
+                 password=None, max_connections=4, requests_per_second=None,
+                 transport=None):
+        self.name = name
+        self.base_url = base_url
+        self.download_location = download_location
+        self.username = username
+        self.password = password
+        self.session_id = None
+        self.cache = {}
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1,
+                                                pool_maxsize=max_connections)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        #None means look up the transport on every request, see _get_transport
+        self.transport = transport
+        self.limiter = None
+        if requests_per_second is not None:
+            self.limiter = RateLimiter(requests_per_second)
+        self._connections = threading.BoundedSemaphore(max_connections)
+        #set by TenantScheduler to share a global budget with other tenants
+        self.budget = None
+
+    def __repr__(self):
+        return f"Tenant({self.name!r}, {self.base_url!r})"
+
+    def _get_transport(self):
+        """The transport passed in, else the global one if it was changed from
+        plain `requests`, else this tenant's own session
+        """
+        if self.transport is not None:
+            return self.transport
+        if tools._TRANSPORT is not requests:
+            return tools._TRANSPORT
+        return self.session
+
+    def _send(self, method, url, **kwargs):
+        transport = self._get_transport()
+        if self.limiter is not None:
+            self.limiter.acquire()
+        with self._connections:
+            if self.budget is None:
+                return getattr(transport, method)(url, **kwargs)
+            with self.budget.slot(self.name):
+                return getattr(transport, method)(url, **kwargs)
+
+    def get(self, url, params=None, **kwargs):
+        return self._send("get", url, params=params, **kwargs)
+
+    def post(self, url, data=None, **kwargs):
+        return self._send("post", url, data=data, **kwargs)
+
+    @contextlib.contextmanager
+    def activate(self):
+        """Makes elexio_api functions called in this thread use this tenant
+        """
+        previous = getattr(tools._LOCAL, "tenant", None)
+        tools._LOCAL.tenant = self
+        try:
+            yield self
+        finally:
+            tools._LOCAL.tenant = previous
+
+    def login(self):
+        """Logs in with this tenant's username and password and returns the session id
+        """
+        with self.activate():
+            self.session_id = tools.get_session_id(self.username, self.password)
+        return self.session_id
+
+    def close(self):
+        self.session.close()
+
+
+def load_tenants(path, **kwargs):
+    """Reads tenants from a JSON file
+
+    The file holds a list like
+    `[{"name": "wheatland", "base_url": "https://...", "download_location": "",
+    "username": "...", "password": "..."}]`. Extra keyword arguments are
+    passed to every `Tenant`, e.g. `requests_per_second=5`
+    """
+    with open(path, "r") as tenant_file:
+        tenant_configs = json.load(tenant_file)
+    tenants = []
+    for config in tenant_configs:
+        options = dict(kwargs)
+        options.update(config)
+        tenants.append(Tenant(**options))
+    return tenants
+
+
+class TenantScheduler:
+    """Runs a job for every tenant concurrently under one shared budget
+
+    Parameters
+    ----------
+    tenants : `list` of `Tenant`
+    max_concurrency : `int`, optional (default: 8)
+        Most requests in flight across all tenants at once
+    max_workers : `int`, optional
+        Most tenants worked on at once. Defaults to all of them
+
+    """
+
+    def __init__(self, tenants, max_concurrency=8, max_workers=None):
+        self.tenants = list(tenants)
+        self.budget = FairBudget(max_concurrency)
+        self.max_workers = max_workers or max(1, len(self.tenants))
+        for tenant in self.tenants:
+            tenant.budget = self.budget
+
+    def _run_one(self, tenant, job):
+        with tenant.activate():
+            if tenant.session_id is None:
+                tenant.login()
+            return job(tenant)
+
+    def run(self, job):
+        """Calls `job(tenant)` for every tenant with the tenant activated
+
+        Tenants that haven't logged in yet are logged in first.
+
+        Returns
+        -------
+        `dict`
+            {tenant name: what the job returned}. If the job raised for a
+            tenant, the exception is stored instead so one failing tenant
+            doesn't stop the rest
+
+        """
+        results = {}
+        with concurrent.futures.ThreadPoolExecutor(self.max_workers) as pool:
+            futures = {pool.submit(self._run_one, tenant, job): tenant
+                       for tenant in self.tenants}
+            for future in concurrent.futures.as_completed(futures):
+                tenant = futures[future]
+                try:
+                    results[tenant.name] = future.result()
+                except Exception as err:
+                    results[tenant.name] = err
+        return results
@@ -4,8 +4,12 @@ import pandas as pd
 import os
 import getpass
 import json
+import threading
 import pkg_resources as pkg
 
+from .frames import optimize_frame, memory_report
+from .transfer import ACCEPT_ENCODING, _record_transfer
+
 
 #read in config file to get download location
 def _read_config():
@@ -25,6 +29,14 @@ BASEURL, DOWNLOAD_LOCATION = _read_config()
 DELIMITER = "\t"
 
 
+#Every call to Elexio goes through this. It only needs `get` and `post` 
+#methods that work like the requests module. See `set_transport`
+_TRANSPORT = requests
+
+#The tenant (see `elexio_api.tenants`) being worked on in this thread, if any
+_LOCAL = threading.local()
+
+
 #these are all of the functions
 __all__ = ["get_session_id",
            "download_all",
@@ -36,7 +48,8 @@ __all__ = ["get_session_id",
            "get_all_users",
            "get_user_attendance",
            "get_all_attendance",
-           "update_all_users"]
+           "update_all_users",
+           "set_transport"]
 
 
 
@@ -46,10 +59,59 @@ __all__ = ["get_session_id",
 def _request_get_data(url_suffix, parameters={}):
     """Helper function to get a response with certain parameters and return the data
     """
-    url = BASEURL + url_suffix
-    response = requests.get(url, params=parameters)
+    url = _base_url() + url_suffix
+    response = _get_transport().get(url, params=parameters,
+                                    headers={"Accept-Encoding": ACCEPT_ENCODING})
     response.raise_for_status()
-    return response.json()['data']
+    data = response.json()['data']
+    _record_transfer(url, response)
+    return data
+
+def _wanted_fields(fields, meta_fields=None):
+    """Helper function to get the set of keys to keep from the fields asked for.
+    Meta fields can be given by key ('text1') or, if meta_fields is passed, by
+    label ('Race'). uid is always kept. None means keep everything
+    """
+    if fields is None:
+        return None
+    wanted = set(fields) | {"uid"}
+    if meta_fields:
+        wanted |= {field for field, name in meta_fields.items() if name in wanted}
+    return wanted
+
+def _project(record, wanted):
+    """Helper function to drop the keys of a record that aren't wanted
+    """
+    if wanted is None:
+        return record
+    return {key: value for key, value in record.items() if key in wanted}
+
+def _active_tenant():
+    """Helper function to get the tenant activated in this thread, or None
+    """
+    return getattr(_LOCAL, "tenant", None)
+
+def _base_url():
+    """Helper function to get the active tenant's base url, or BASEURL
+    """
+    tenant = _active_tenant()
+    return BASEURL if tenant is None else tenant.base_url
+
+def _download_location(file_location=None):
+    """Helper function to get where to save files. An explicit file_location
+    wins, then the active tenant's download location, then DOWNLOAD_LOCATION
+    """
+    if file_location is not None:
+        return file_location
+    tenant = _active_tenant()
+    return DOWNLOAD_LOCATION if tenant is None else tenant.download_location
+
+def _get_transport():
+    """Helper function to get the active tenant, which sends requests through
+    its own connection pool, or the global transport
+    """
+    tenant = _active_tenant()
+    return _TRANSPORT if tenant is None else tenant
 
 def _parse_names(last_name_dict):
     """Helper function to unpack the data when grouped by last name letter
@@ -61,15 +123,43 @@ def _parse_names(last_name_dict):
     return big_list
     
 
-def _get_metadata(session_id):
+def _get_metadata(session_id, with_types=False):
     """Returns a dictionary of {'text1': 'Race'} etc
+    
+    If `with_types` is True, also returns a second dictionary of the field
+    types after renaming, {'Race': 'text', 'Baptism Date': 'date'} etc
     """
-    meta_data = _request_get_data('/user/get_meta_data', parameters={"session_id":session_id})
-    meta_date_fields = meta_data['dateFieldLabels']
+    tenant = _active_tenant()
+    cache_key = ("meta_data", session_id)
+    if tenant is not None and cache_key in tenant.cache:
+        meta_data = tenant.cache[cache_key]
+    else:
+        meta_data = _request_get_data('/user/get_meta_data', parameters={"session_id":session_id})
+        if tenant is not None:
+            tenant.cache[cache_key] = meta_data
+    #copy so the cached labels aren't changed by the update below
+    meta_date_fields = dict(meta_data['dateFieldLabels'])
     meta_text_fields = meta_data['textFieldLabels']
+    field_types = {name: "date" for name in meta_date_fields.values()}
+    field_types.update({name: "text" for name in meta_text_fields.values()})
     meta_date_fields.update(meta_text_fields)
+    if with_types:
+        return meta_date_fields, field_types
     return meta_date_fields
 
+def _optimize_with_report(data_frame, field_types=None, use_arrow=False):
+    """Helper function to optimize a frame and print how much memory it saved
+    """
+    if field_types is None:
+        field_types = {}
+    date_columns = [name for name, kind in field_types.items() if kind == "date"]
+    optimized = optimize_frame(data_frame, date_columns=date_columns,
+                               use_arrow=use_arrow)
+    report = memory_report(data_frame, optimized)
+    print(f"Memory reduced from {report['before']:,} to {report['after']:,} bytes "
+          f"({report['ratio']:.0%} of the original)")
+    return optimized
+
 def _write_config(file="config.json", url=None, location=None):
     """Prompts user and writes to the config file
     
@@ -106,6 +196,28 @@ def _write_config(file="config.json", url=None, location=None):
         config_file.write(config_str)
     return
 
+def set_transport(transport=None):
+    """Sets what every request to Elexio is sent through and returns the old one
+    
+    Parameters
+    ----------
+    transport : optional
+        Anything with `get(url, params=..., **kwargs)` and
+        `post(url, data=..., **kwargs)` methods that return `requests.Response`
+        like objects, e.g. a `requests.Session` or a `Cassette`. GETs pass
+        `headers=` (asking for compressed responses), so the methods have to
+        accept it. None goes back to plain `requests`
+    
+    Returns
+    -------
+    The previous transport
+    
+    """
+    global _TRANSPORT
+    previous = _TRANSPORT
+    _TRANSPORT = requests if transport is None else transport
+    return previous
+
 def get_session_id(username=None, password=None):
     """Posts username and password and returns a session_id string
     Prompts user for username and password
@@ -124,8 +236,8 @@ def get_session_id(username=None, password=None):
 
     for i in range(3):
         #send a request post with your info in it to receive a session_id
-        session_url = BASEURL + "/user/login"
-        session_response = requests.post(session_url, data=login_info)
+        session_url = _base_url() + "/user/login"
+        session_response = _get_transport().post(session_url, data=login_info)
         
         #this will raise an error if we get a 404, 401, or other error, otherwise does nothing
         #print out the error and try again            
@@ -150,14 +262,31 @@ def get_session_id(username=None, password=None):
 
 
 
-def download_all(session_id, write=True, file_location=DOWNLOAD_LOCATION, 
-                 filename="people_all.xlsx", delim=DELIMITER):
+def download_all(session_id, write=True, file_location=None, 
+                 filename="people_all.xlsx", delim=DELIMITER, optimize=False,
+                 use_arrow=False, fields=None):
     """Requests all of the people and saves it in an excel file
     
+    Parameters
+    ----------
+    fields : `list`, optional
+        Only keep these columns, e.g. `["uid", "fname", "lname", "Race"]`. 
+        Meta fields can be given by their label. The rest are dropped before
+        the DataFrame is built. uid is always kept
+    optimize : `bool`, optional (default: False)
+        Use compact dtypes (categoricals, downcast integers, parsed meta date
+        fields) for the returned DataFrame and print the memory saved
+    use_arrow : `bool`, optional (default: False)
+        With `optimize`, store the remaining strings in arrow. Needs pyarrow
+    
     """
     
     people_data = _request_get_data("/people/all", {"session_id":session_id})
     
+    #get metadata to label the csv
+    meta_fields, field_types = _get_metadata(session_id, with_types=True)
+    wanted = _wanted_fields(fields, meta_fields)
+    
     #empty list to store people
     big_list = []
     
@@ -165,18 +294,16 @@ def download_all(session_id, write=True, file_location=DOWNLOAD_LOCATION,
     #which we can then loop through
     for last_letter, people_with_last in people_data.items():
         for person in people_with_last:
-            big_list.append(person)
+            big_list.append(_project(person, wanted))
     
     
     #This gets us the columns in the correct order
-    ordered_columns = list(people_data['A'][0].keys())
+    ordered_columns = [column for column in people_data['A'][0].keys()
+                       if wanted is None or column in wanted]
     
     #pandas is the python package for dealing with data in columns
     data_frame = pd.DataFrame(big_list, columns=ordered_columns)
     
-    #get metadata to label the csv
-    meta_fields = _get_metadata(session_id)
-    
     #rename columns in the dataframe
     for i in range(len(ordered_columns)):
         for field, name in meta_fields.items():
@@ -185,7 +312,10 @@ def download_all(session_id, write=True, file_location=DOWNLOAD_LOCATION,
                 
     data_frame.columns = ordered_columns
     
-    full_path = os.path.join(file_location, filename)
+    if optimize:
+        data_frame = _optimize_with_report(data_frame, field_types, use_arrow)
+    
+    full_path = os.path.join(_download_location(file_location), filename)
     
     if write:
         #data_frame.to_csv(full_path, sep=delim)
@@ -199,26 +329,42 @@ def download_all(session_id, write=True, file_location=DOWNLOAD_LOCATION,
 
 
     
-def get_pdf_of_user(session_id, user_id, file_location=DOWNLOAD_LOCATION):
+def get_pdf_of_user(session_id, user_id, file_location=None, store=None):
+    """Downloads the pdf for one person and saves it as {user_id}.pdf
+    
+    If a `ContentStore` is passed as `store`, the pdf is put in the store 
+    instead of file_location. Returns True if it changed since it was last 
+    stored and False if nothing was written
+    """
     
-    url = BASEURL + '/people/' + str(user_id) 
+    url = _base_url() + '/people/' + str(user_id) 
     parameters = {"session_id": session_id, "format":"pdf"}
     
-    pdf_response = requests.get(url, params=parameters)
+    pdf_response = _get_transport().get(url, params=parameters,
+                                        headers={"Accept-Encoding": ACCEPT_ENCODING})
     pdf_response.raise_for_status()
+    _record_transfer(url, pdf_response)
+    
+    if store is not None:
+        return store.put(user_id, pdf_response.content)
     
     filename = str(user_id) + '.pdf'
-    full_path = os.path.join(file_location, filename)
+    full_path = os.path.join(_download_location(file_location), filename)
     with open(full_path, 'wb') as pdf_file:
         pdf_file.write(pdf_response.content)
     return
 
-def get_groups(session_id, write=True, file_location=DOWNLOAD_LOCATION, 
-               filename="groups.xlsx", delim=DELIMITER):
+def get_groups(session_id, write=True, file_location=None, 
+               filename="groups.xlsx", delim=DELIMITER, fields=None):
     """Gets all of the groups and their descriptions, but not who is in them
+    
+    fields : `list`, optional
+        Only keep these columns. gid is always kept
     """
     
     groups_data = _request_get_data("/groups/sync", {"session_id": session_id})
+    wanted = None if fields is None else set(fields) | {"gid"}
+    groups_data = [_project(group, wanted) for group in groups_data]
     ordered_columns = list(groups_data[0].keys())
     groups_frame = pd.DataFrame(groups_data, columns=ordered_columns)
     
@@ -230,7 +376,7 @@ def get_groups(session_id, write=True, file_location=DOWNLOAD_LOCATION,
         pass
     
     if write:
-        full_path = os.path.join(file_location, filename)
+        full_path = os.path.join(_download_location(file_location), filename)
         groups_frame.to_excel(full_path)
         return
     else:
@@ -239,15 +385,20 @@ def get_groups(session_id, write=True, file_location=DOWNLOAD_LOCATION,
     
 
 def get_users_in_group(session_id, group_id,  group_name=None, write=True, 
-                       file_location=DOWNLOAD_LOCATION, delim=DELIMITER):
+                       file_location=None, delim=DELIMITER, fields=None):
     """Gets the users in one group
+    
+    fields : `list`, optional
+        Only keep these columns of each person, instead of the first few. uid
+        and gid (and name, if group_name is passed) are always kept
     """
     url_suffix = "/groups/" + str(group_id) + "/people"
     parameters = {"session_id": session_id}
     
     group_users_data = _request_get_data(url_suffix, parameters)
     
-    user_list = _parse_names(group_users_data)
+    wanted = _wanted_fields(fields)
+    user_list = [_project(user, wanted) for user in _parse_names(group_users_data)]
     ordered_columns = user_list[0].keys()
     user_df = pd.DataFrame(user_list, columns=ordered_columns)
     
@@ -264,28 +415,33 @@ def get_users_in_group(session_id, group_id,  group_name=None, write=True,
     
 
     
-    #only need the first 4 columns
+    #only need the first 4 columns unless fields were asked for
     #added if clause so when group name is passed we don't lose uid
-    if group_name is not None:
+    if fields is None and group_name is not None:
         user_df = user_df.iloc[:, :5]
-    else:
+    elif fields is None:
         user_df = user_df.iloc[:, :4]
     
     if write:
         filename = 'users_in_group_' + str(group_id) + '.xlsx'
-        full_path = os.path.join(file_location, filename)
+        full_path = os.path.join(_download_location(file_location), filename)
         user_df.to_excel(full_path)
         return
     else:
         return user_df
     
     
-def get_users_in_all_groups(session_id, write=True, file_location=DOWNLOAD_LOCATION, 
-                            filename="users_in_all_groups.xlsx", delim=DELIMITER):
+def get_users_in_all_groups(session_id, write=True, file_location=None, 
+                            filename="users_in_all_groups.xlsx", delim=DELIMITER,
+                            fields=None):
     """Gets the people every different group. Will take a while to request every group
+    
+    fields : `list`, optional
+        Passed to `get_users_in_group`
     """
     
-    group_frame = get_groups(session_id, write=False)
+    group_frame = get_groups(session_id, write=False, 
+                             fields=["gid", "name", "peopleCount"])
     
     big_df = pd.DataFrame()
     print("Grabbing all of the users in every group. Will take a few minutes...")
@@ -296,11 +452,12 @@ def get_users_in_all_groups(session_id, write=True, file_location=DOWNLOAD_LOCAT
         if rows.peopleCount == 0:
             #skips groups that don't have anyone in them
             continue
-        small_df = get_users_in_group(session_id, gid, write=False, group_name=g_name)
+        small_df = get_users_in_group(session_id, gid, write=False, group_name=g_name,
+                                      fields=fields)
         big_df = big_df.append(small_df, sort=False)
     
     if write:
-        full_path = os.path.join(file_location, filename)
+        full_path = os.path.join(_download_location(file_location), filename)
         big_df.to_excel(full_path)
         return
     else:
@@ -309,17 +466,27 @@ def get_users_in_all_groups(session_id, write=True, file_location=DOWNLOAD_LOCAT
        
     
         
-def get_user(session_id, user_id):
+def get_user(session_id, user_id, fields=None):
     """Gets all of the info on a single person. The family, group, and note data 
     has to be parsed specially
+    
+    fields : `list`, optional
+        Only keep these keys, e.g. `["fname", "lname", "text1"]`. Unwanted
+        family, groups and note data is dropped before it's parsed
     """
     
     url_suffix = "/people/" + str(user_id)
     parameters = {"session_id":session_id}
     person_data = _request_get_data(url_suffix, parameters)
     
+    wanted = _wanted_fields(fields)
+    if wanted is not None:
+        #fid comes from the family data
+        keep = wanted | {'family'} if 'fid' in wanted else wanted
+        person_data = _project(person_data, keep)
+    
     person_data['fid'] = ""
-    if person_data['family'] != []:
+    if person_data.get('family'):
         family_list = []
         for person in person_data['family']:
             relative = f"{person['uid']}:{person['relationship']}"
@@ -328,35 +495,40 @@ def get_user(session_id, user_id):
         family_string = " ".join(family_list)
         person_data['family'] = family_string
     
-    if person_data['groups'] != []:
+    if person_data.get('groups'):
         group_list = []
         for group in person_data['groups']:
             group_list.append(str(group['gid']))
         person_data['groups'] = " ".join(group_list)
-    if person_data['note']:
+    if person_data.get('note'):
         notes = []
         for key, value in person_data['note'].items():
             notes.append(f'{key}:{value}')
         person_data['note'] = " ".join(notes)
-    ordered_columns = person_data.keys()
+    ordered_columns = [column for column in person_data.keys()
+                       if wanted is None or column in wanted]
     small_df = pd.DataFrame([person_data], columns=ordered_columns)
     
     return small_df
 
-def get_all_users(session_id, write=True, file_location=DOWNLOAD_LOCATION, 
-                  filename='all_users_full.xlsx', delim=DELIMITER):
+def get_all_users(session_id, write=True, file_location=None, 
+                  filename='all_users_full.xlsx', delim=DELIMITER, fields=None):
     """Gets the full data on all of the users, one at a time
+    
+    fields : `list`, optional
+        Only keep these columns. Meta fields can be given by their label
     """
     
-    people_all = download_all(session_id, write=False)
+    people_all = download_all(session_id, write=False, fields=["uid"])
+    meta_fields = _get_metadata(session_id)
+    wanted = _wanted_fields(fields, meta_fields)
     big_df = pd.DataFrame()
     print("Grabbing every user one at a time...this will take a few minutes")
     for index, rows in people_all.iterrows():
-        small_df = get_user(session_id, rows['uid'])
+        small_df = get_user(session_id, rows['uid'], fields=wanted)
         big_df = big_df.append(small_df, sort=False)
         
     df_columns = list(big_df.columns)
-    meta_fields = _get_metadata(session_id)
     for i in range(len(df_columns)):
         for field, name in meta_fields.items():
             if df_columns[i] == field:
@@ -364,7 +536,7 @@ def get_all_users(session_id, write=True, file_location=DOWNLOAD_LOCATION,
     big_df.columns = df_columns
     
     if write:
-        full_path = os.path.join(file_location, filename)
+        full_path = os.path.join(_download_location(file_location), filename)
         big_df.to_excel(full_path)
         return
     else:
@@ -372,7 +544,7 @@ def get_all_users(session_id, write=True, file_location=DOWNLOAD_LOCATION,
 
 
 def update_all_users(session_id, input_filepath=None, write=True, 
-                     write_file_location=DOWNLOAD_LOCATION, 
+                     write_file_location=None, 
                      write_filename="updated_all_users_full.xlsx"):
     """Compares the local users file to the current database online and updates local
     
@@ -381,8 +553,8 @@ def update_all_users(session_id, input_filepath=None, write=True,
     """
     
     if input_filepath is None:
-        input_filepath = os.path.join(DOWNLOAD_LOCATION, "all_users_full.xlsx")
-    people_all = download_all(session_id, write=False)
+        input_filepath = os.path.join(_download_location(), "all_users_full.xlsx")
+    people_all = download_all(session_id, write=False, fields=["uid"])
     local_all = pd.read_excel(input_filepath)
     to_append = pd.DataFrame()
     local_list = list(local_all.uid)
@@ -392,39 +564,51 @@ def update_all_users(session_id, input_filepath=None, write=True,
             to_append = to_append.append(get_user(session_id, person), sort=False)
     local_all = local_all.append(to_append)
     if write:
-        full_path = os.path.join(write_file_location, write_filename)
+        full_path = os.path.join(_download_location(write_file_location), write_filename)
         local_all.to_excel(full_path)
         return
     else:
         return local_all
 
 
-def get_user_attendance(session_id, uid, week_offset=0, number_of_weeks=50, 
-                      write=True, file_location=DOWNLOAD_LOCATION, delim=DELIMITER):
-    """Gets a single user's attendance. 
+def _get_attendance_items(session_id, uid, start=0, count=50):
+    """Helper function to get one window of a user's attendance as a list of dicts
     """
-    
     url_suffix = "/attendance/for_person/" + str(uid)
     parameters = {"session_id":session_id, 
-                  "start": str(week_offset), 
-                  "count": str(number_of_weeks)}
-    
+                  "start": str(start), 
+                  "count": str(count)}
     
     att_data = _request_get_data(url_suffix, parameters)
-    att_items = att_data['items']
-    att_df = pd.DataFrame(att_items)
+    return att_data['items']
+
+def get_user_attendance(session_id, uid, week_offset=0, number_of_weeks=50, 
+                      write=True, file_location=None, delim=DELIMITER, fields=None):
+    """Gets a single user's attendance. 
+    
+    fields : `list`, optional
+        Only keep these keys of each attendance item
+    """
+    
+    att_items = _get_attendance_items(session_id, uid, week_offset, number_of_weeks)
+    wanted = _wanted_fields(fields)
+    att_df = pd.DataFrame([_project(item, wanted) for item in att_items])
+    
+    #add a uid column so the frames from get_all_attendance can be told apart
+    if 'uid' not in att_df.columns:
+        att_df.insert(0, 'uid', uid)
     
     if write:
         filename = "user_" + str(uid) + "_attendance.xlsx"
-        full_path = os.path.join(file_location, filename)
+        full_path = os.path.join(_download_location(file_location), filename)
         att_df.to_excel(full_path)
         return
     else:
         return att_df
 
 def get_all_attendance(session_id, week_off=0, number_of_weeks=50, write=True, 
-                   file_location=DOWNLOAD_LOCATION, filename="all_attendance.xlsx", 
-                   delim=DELIMITER):
+                   file_location=None, filename="all_attendance.xlsx", 
+                   delim=DELIMITER, optimize=False, use_arrow=False, fields=None):
     """Goes through every user and gets their attendence. 
     
     Parameters
@@ -434,7 +618,7 @@ def get_all_attendance(session_id, week_off=0, number_of_weeks=50, write=True,
     write : `bool`, optional (default: True)
         If true, writes an excel file and returns `None`
         False returns a DataFrame
-    file_location : `str`, optional (default is a global variable)
+    file_location : `str`, optional (default is the tenant or global download location)
         Specify the folder location to save file
     filename : `str`, optional (default: `"all_attendance.xlsx"`)
     delim : `str`, optional (default is global variable)
@@ -445,22 +629,33 @@ def get_all_attendance(session_id, week_off=0, number_of_weeks=50, write=True,
     number_of_weeks : `int`, optional (default: 50)
         the number of events to count. Elexio default is 50. Entering a very 
         large number will ensure that you get everything
+    optimize : `bool`, optional (default: False)
+        Use compact dtypes for the returned DataFrame and print the memory saved
+    use_arrow : `bool`, optional (default: False)
+        With `optimize`, store the remaining strings in arrow. Needs pyarrow
+    fields : `list`, optional
+        Only keep these keys of each attendance item
     
     """
     
     
-    people_all = download_all(session_id, write=False)
+    people_all = download_all(session_id, write=False, fields=["uid"])
     big_df = pd.DataFrame()
     print("Grabbing attendance of every user one at a time...this will take a few minutes")
     for index, rows in people_all.iterrows():
         small_df = get_user_attendance(session_id, uid=rows['uid'],
                                        write=False, week_offset=week_off, 
-                                       number_of_weeks=number_of_weeks)
+                                       number_of_weeks=number_of_weeks,
+                                       fields=fields)
         
         big_df = big_df.append(small_df)
     
+    if optimize:
+        #parse the attendance dates once here instead of in every later step
+        big_df = _optimize_with_report(big_df, {"date": "date"}, use_arrow)
+    
     if write:
-        full_path = os.path.join(file_location, filename)
+        full_path = os.path.join(_download_location(file_location), filename)
         big_df.to_excel(full_path)
         return
     else:
@@ -0,0 +1,100 @@
+"""
+Count the bytes sent by Elexio for each request.
+
+Requests ask Elexio for gzip or deflate compressed responses. Inside a
+`track_transfers()` block every response is logged with the bytes that came
+over the wire and the bytes after decompressing:
+
+    with track_transfers() as log:
+        download_all(session_id, write=False, fields=["uid", "fname", "lname"])
+    log.totals()
+"""
+import contextlib
+import threading
+
+
+__all__ = ["TransferLog",
+           "track_transfers"]
+
+
+#sent with every GET so Elexio compresses the responses
+ACCEPT_ENCODING = "gzip, deflate"
+
+#the logs being filled in this thread
+_LOGS = threading.local()
+
+
+def _wire_bytes(response):
+    """Helper function to get how many bytes a response took on the wire.
+
+    urllib3 counts the compressed bytes it read. Responses without a raw
+    stream (e.g. replayed from a cassette) fall back to Content-Length, then
+    to the decompressed size
+    """
+    raw = getattr(response, "raw", None)
+    if raw is not None and hasattr(raw, "tell"):
+        try:
+            read = raw.tell()
+            if read:
+                return read
+        except (AttributeError, OSError, ValueError):
+            pass
+    length = response.headers.get("Content-Length")
+    if length is not None and length.isdigit():
+        return int(length)
+    return len(response.content)
+
+
+def _record_transfer(url, response):
+    """Adds a response to every active `TransferLog` in this thread
+    """
+    logs = getattr(_LOGS, "stack", None)
+    if not logs:
+        return
+    elapsed = getattr(response, "elapsed", None)
+    entry = {"url": url,
+             "status": response.status_code,
+             "encoding": response.headers.get("Content-Encoding", "identity"),
+             "wire_bytes": _wire_bytes(response),
+             "decoded_bytes": len(response.content),
+             "elapsed": elapsed.total_seconds() if elapsed is not None else None}
+    for log in logs:
+        log.append(entry)
+
+
+class TransferLog(list):
+    """A list of one dictionary per response with url, status, encoding,
+    wire_bytes, decoded_bytes and elapsed seconds
+    """
+
+    def totals(self):
+        """Returns the number of requests and total bytes, and how much
+        compression saved
+        """
+        wire = sum(entry["wire_bytes"] for entry in self)
+        decoded = sum(entry["decoded_bytes"] for entry in self)
+        return {"requests": len(self),
+                "wire_bytes": wire,
+                "decoded_bytes": decoded,
+                "compression_ratio": wire / decoded if decoded else 1.0}
+
+
+@contextlib.contextmanager
+def track_transfers():
+    """Logs every Elexio response in this thread while the block runs
+
+    Blocks can be nested, each log gets the responses made inside it.
+    """
+    log = TransferLog()
+    if getattr(_LOGS, "stack", None) is None:
+        _LOGS.stack = []
+    _LOGS.stack.append(log)
+    try:
+        yield log
+    finally:
+        #TransferLog is a list, so nested logs with the same entries compare
+        #equal. Remove this one by identity, not with list.remove
+        for position in range(len(_LOGS.stack) - 1, -1, -1):
+            if _LOGS.stack[position] is log:
+                del _LOGS.stack[position]
+                break
@@ -0,0 +1,441 @@
+"""
+Split a crawl of every person between many worker processes.
+
+A coordinator puts the uids from `download_all` into a SQLite file in
+batches. Any number of worker processes lease a batch, fetch everyone in it
+and save a partial result. Leases expire, so the batches of a worker that
+crashed are picked up again. A batch that failed waits a little longer before
+each retry, and after `max_attempts` it is marked failed instead of being
+retried forever. When the queue is empty, `merge_crawl` puts the partial
+results together.
+
+SQLite's file locking isn't reliable on network file systems like NFS and
+SMB, so two workers could lease the same batch or corrupt the file there.
+Keep the queue on a local disk and run the workers on that machine. Only
+the output folder needs to be shared.
+
+    # coordinator
+    enqueue_crawl(session_id, "crawl.db", kind="attendance")
+    # on each worker
+    run_worker(session_id, "crawl.db", "partials")
+    # when done
+    merge_crawl("crawl.db", "partials", kind="attendance")
+"""
+import json
+import os
+import socket
+import sqlite3
+import time
+
+import pandas as pd
+
+from . import tools
+
+
+__all__ = ["WorkQueue",
+           "enqueue_crawl",
+           "run_worker",
+           "merge_crawl"]
+
+
+#what a worker does with each uid, and the file merge_crawl writes by default
+CRAWL_KINDS = {"user": "all_users_full.xlsx",
+               "attendance": "all_attendance.xlsx"}
+
+
+class WorkQueue:
+    """Batches of uids in a SQLite file that workers lease, work on and complete
+
+    Parameters
+    ----------
+    path : `str`
+        SQLite file. Created if it doesn't exist
+    timeout : `float`, optional (default: 30)
+        Seconds to wait for another process to unlock the file
+    max_attempts : `int`, optional (default: 3)
+        Times a batch may be leased. A batch that was given back with an
+        error, or whose lease ran out, that many times is marked failed
+    retry_delay : `float`, optional (default: 30)
+        Seconds a batch given back with an error waits before it can be
+        leased again. The wait doubles with every attempt
+
+    """
+
+    def __init__(self, path, timeout=30, max_attempts=3, retry_delay=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        #autocommit mode, transactions are started by hand where needed
+        self.connection = sqlite3.connect(path, timeout=timeout,
+                                          isolation_level=None)
+        self.connection.execute("""
+            CREATE TABLE IF NOT EXISTS batches (
+                id INTEGER PRIMARY KEY,
+                kind TEXT NOT NULL,
+                uids TEXT NOT NULL,
+                status TEXT NOT NULL DEFAULT 'pending',
+                worker TEXT,
+                lease_expires REAL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                output TEXT,
+                error TEXT,
+                not_before REAL
+            )""")
+        #queues made by older versions are missing the newer columns
+        columns = {row[1] for row in
+                   self.connection.execute("PRAGMA table_info(batches)")}
+        for column in ("error TEXT", "not_before REAL"):
+            if column.split()[0] not in columns:
+                self.connection.execute(f"ALTER TABLE batches ADD COLUMN {column}")
+
+    def close(self):
+        self.connection.close()
+
+    def enqueue(self, uids, kind, batch_size=50):
+        """Adds the uids in batches of `batch_size` and returns the number of batches
+        """
+        uids = [int(uid) for uid in uids]
+        rows = [(kind, json.dumps(uids[start:start + batch_size]))
+                for start in range(0, len(uids), batch_size)]
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.executemany(
+                "INSERT INTO batches (kind, uids) VALUES (?, ?)", rows)
+        return len(rows)
+
+    def clear(self, kind=None):
+        """Deletes every batch, or every batch of one kind
+        """
+        with self.connection:
+            if kind is None:
+                self.connection.execute("DELETE FROM batches")
+            else:
+                self.connection.execute("DELETE FROM batches WHERE kind = ?", (kind,))
+
+    def lease(self, worker, lease_seconds=600):
+        """Takes the next pending or expired batch
+
+        Batches waiting to be retried are skipped until their wait is over.
+
+        Returns
+        -------
+        `tuple` or None
+            (batch id, kind, list of uids), or None if there's nothing to
+            lease right now. See `next_retry`
+
+        """
+        now = time.time()
+        with self.connection:
+            #IMMEDIATE takes the write lock, so two workers can't lease the same batch
+            self.connection.execute("BEGIN IMMEDIATE")
+            #batches whose workers keep dying aren't handed out again
+            self.connection.execute("""
+                UPDATE batches
+                SET status = 'failed', worker = NULL, lease_expires = NULL,
+                    error = COALESCE(error, 'lease expired')
+                WHERE status = 'leased' AND lease_expires < ? AND attempts >= ?""",
+                (now, self.max_attempts))
+            row = self.connection.execute("""
+                SELECT id, kind, uids FROM batches
+                WHERE (status = 'pending' AND (not_before IS NULL OR not_before <= ?))
+                   OR (status = 'leased' AND lease_expires < ?)
+                ORDER BY id LIMIT 1""", (now, now)).fetchone()
+            if row is None:
+                return None
+            self.connection.execute("""
+                UPDATE batches
+                SET status = 'leased', worker = ?, lease_expires = ?,
+                    attempts = attempts + 1, not_before = NULL
+                WHERE id = ?""", (worker, now + lease_seconds, row[0]))
+        return row[0], row[1], json.loads(row[2])
+
+    def next_retry(self):
+        """Returns the time (as from `time.time()`) the next batch waiting to
+        be retried can be leased, or None if no batch is waiting
+        """
+        row = self.connection.execute("""
+            SELECT MIN(not_before) FROM batches
+            WHERE status = 'pending' AND not_before IS NOT NULL""").fetchone()
+        return row[0]
+
+    def renew(self, batch_id, worker, lease_seconds=600):
+        """Extends a lease. Returns False if the worker lost the lease
+        """
+        with self.connection:
+            cursor = self.connection.execute("""
+                UPDATE batches SET lease_expires = ?
+                WHERE id = ? AND worker = ? AND status = 'leased'""",
+                (time.time() + lease_seconds, batch_id, worker))
+        return cursor.rowcount == 1
+
+    def complete(self, batch_id, worker, output):
+        """Marks a batch done with the name of its output file
+
+        Returns False if the lease expired and another worker took the batch,
+        in which case the other worker's output is used
+        """
+        with self.connection:
+            cursor = self.connection.execute("""
+                UPDATE batches SET status = 'done', output = ?, lease_expires = NULL
+                WHERE id = ? AND worker = ? AND status = 'leased'""",
+                (output, batch_id, worker))
+        return cursor.rowcount == 1
+
+    def release(self, batch_id, worker, error=None, backoff=True):
+        """Gives a leased batch back to the queue
+
+        A batch given back with an error can be leased again after
+        `retry_delay` seconds, doubled for every attempt so far, unless
+        `backoff` is False (e.g. the worker was stopped). If the batch
+        has already been leased `max_attempts` times it is marked failed
+        instead. Returns the batch's new status, or None if the worker didn't
+        hold the lease
+        """
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            row = self.connection.execute("""
+                SELECT attempts FROM batches
+                WHERE id = ? AND worker = ? AND status = 'leased'""",
+                (batch_id, worker)).fetchone()
+            if row is None:
+                return None
+            status = "failed" if row[0] >= self.max_attempts else "pending"
+            not_before = None
+            if backoff and error is not None and status == "pending":
+                not_before = time.time() + self.retry_delay * 2 ** (row[0] - 1)
+            self.connection.execute("""
+                UPDATE batches SET status = ?, worker = NULL,
+                    lease_expires = NULL, error = ?, not_before = ?
+                WHERE id = ?""", (status, error, not_before, batch_id))
+        return status
+
+    def progress(self, kind=None):
+        """Returns a dictionary of {'pending': n, 'leased': n, 'done': n, 'failed': n}
+        """
+        query = "SELECT status, COUNT(*) FROM batches"
+        parameters = ()
+        if kind is not None:
+            query += " WHERE kind = ?"
+            parameters = (kind,)
+        counts = {"pending": 0, "leased": 0, "done": 0, "failed": 0}
+        counts.update(self.connection.execute(query + " GROUP BY status",
+                                              parameters).fetchall())
+        return counts
+
+    def outputs(self, kind):
+        """Returns the output file names of the finished batches, in batch order
+        """
+        rows = self.connection.execute("""
+            SELECT output FROM batches WHERE kind = ? AND status = 'done'
+            ORDER BY id""", (kind,)).fetchall()
+        return [row[0] for row in rows]
+
+    def failed(self, kind):
+        """Returns a list of (batch id, uids, error) for the batches that failed
+        """
+        rows = self.connection.execute("""
+            SELECT id, uids, error FROM batches WHERE kind = ? AND status = 'failed'
+            ORDER BY id""", (kind,)).fetchall()
+        return [(row[0], json.loads(row[1]), row[2]) for row in rows]
+
+
+class LeaseLost(Exception):
+    """Raised when a worker's lease ran out and another worker took the batch"""
+
+
+def _check_kind(kind):
+    if kind not in CRAWL_KINDS:
+        raise ValueError(f"kind must be one of {list(CRAWL_KINDS)}, not {kind!r}")
+
+
+def enqueue_crawl(session_id, queue_path, kind="user", batch_size=50, restart=False):
+    """Puts every uid from `download_all` in the queue
+
+    Parameters
+    ----------
+    session_id : `str`
+    queue_path : `str`
+        SQLite file shared with the workers
+    kind : `str`, optional (default: "user")
+        "user" fetches `get_user` for each uid, "attendance" fetches
+        `get_user_attendance`
+    batch_size : `int`, optional (default: 50)
+        Number of uids a worker leases at a time
+    restart : `bool`, optional (default: False)
+        Throw away the batches of this kind already in the queue. Without it,
+        enqueuing a kind that is already there raises a ValueError
+
+    Returns
+    -------
+    `int`
+        Number of batches
+
+    """
+    _check_kind(kind)
+    queue = WorkQueue(queue_path)
+    try:
+        if restart:
+            queue.clear(kind)
+        elif sum(queue.progress(kind).values()):
+            raise ValueError(f"{queue_path} already has {kind} batches. "
+                             "Use restart=True to start over")
+        people_all = tools.download_all(session_id, write=False, fields=["uid"])
+        return queue.enqueue(people_all['uid'], kind, batch_size)
+    finally:
+        queue.close()
+
+
+def _fetch_batch(session_id, kind, uids, number_of_weeks, keep_lease):
+    """Helper function to fetch everyone in one batch into a single DataFrame.
+    keep_lease is called before each uid and raises LeaseLost if the lease is gone
+    """
+    frames = []
+    for uid in uids:
+        keep_lease()
+        if kind == "user":
+            frames.append(tools.get_user(session_id, uid))
+        else:
+            frames.append(tools.get_user_attendance(session_id, uid, write=False,
+                                                    number_of_weeks=number_of_weeks))
+    batch_df = pd.concat(frames, sort=False) if frames else pd.DataFrame()
+    if kind == "user":
+        meta_fields = tools._get_metadata(session_id)
+        batch_df = batch_df.rename(columns=meta_fields)
+    return batch_df
+
+
+def run_worker(session_id, queue_path, output_folder, worker_id=None,
+               lease_seconds=600, number_of_weeks=50, max_batches=None,
+               max_attempts=3, retry_delay=30):
+    """Leases batches and fetches them until the queue is empty
+
+    Each batch is saved as a pickled DataFrame in output_folder. If fetching
+    a batch fails, the batch is given back to the queue to be retried later
+    (or marked failed after `max_attempts`), the error is printed and the
+    worker moves on to the next batch. When only batches waiting to be
+    retried are left, the worker sleeps until the first one is ready. The
+    lease is renewed while a batch is being fetched.
+
+    Parameters
+    ----------
+    session_id : `str`
+    queue_path : `str`
+    output_folder : `str`
+        Folder for the partial results, shared with whoever runs `merge_crawl`
+    worker_id : `str`, optional
+        Defaults to "{hostname}-{pid}"
+    lease_seconds : `float`, optional (default: 600)
+        How long a batch stays leased without being renewed before another
+        worker may take it. Should be longer than fetching one person takes
+    number_of_weeks : `int`, optional (default: 50)
+        Passed to `get_user_attendance`
+    max_batches : `int`, optional
+        Stop after this many batches
+    max_attempts : `int`, optional (default: 3)
+    retry_delay : `float`, optional (default: 30)
+        Passed to `WorkQueue`
+
+    Returns
+    -------
+    `int`
+        Number of batches this worker completed
+
+    """
+    if worker_id is None:
+        worker_id = f"{socket.gethostname()}-{os.getpid()}"
+    os.makedirs(output_folder, exist_ok=True)
+    queue = WorkQueue(queue_path, max_attempts=max_attempts,
+                      retry_delay=retry_delay)
+    completed = 0
+    try:
+        while max_batches is None or completed < max_batches:
+            leased = queue.lease(worker_id, lease_seconds)
+            if leased is None:
+                retry_at = queue.next_retry()
+                if retry_at is None:
+                    break
+                time.sleep(max(0, retry_at - time.time()))
+                continue
+            batch_id, kind, uids = leased
+            renewed = [time.monotonic()]
+
+            def keep_lease():
+                #renew once a third of the lease has gone by
+                if time.monotonic() - renewed[0] < lease_seconds / 3:
+                    return
+                if not queue.renew(batch_id, worker_id, lease_seconds):
+                    raise LeaseLost(f"Lost the lease on batch {batch_id}")
+                renewed[0] = time.monotonic()
+
+            try:
+                batch_df = _fetch_batch(session_id, kind, uids, number_of_weeks,
+                                        keep_lease)
+            except LeaseLost as err:
+                print(err)
+                continue
+            except Exception as err:
+                status = queue.release(batch_id, worker_id, error=repr(err))
+                print(f"Batch {batch_id} failed ({status}): {err!r}")
+                continue
+            except BaseException:
+                queue.release(batch_id, worker_id, error="interrupted",
+                              backoff=False)
+                raise
+            output = f"{kind}_{batch_id:06d}_{worker_id}.pkl"
+            temp_path = os.path.join(output_folder, output + ".tmp")
+            batch_df.to_pickle(temp_path, compression=None)
+            os.replace(temp_path, os.path.join(output_folder, output))
+            if queue.complete(batch_id, worker_id, output):
+                completed += 1
+            else:
+                #someone else finished this batch after our lease ran out
+                os.remove(os.path.join(output_folder, output))
+    finally:
+        queue.close()
+    return completed
+
+
+def merge_crawl(queue_path, output_folder, kind="user", write=True,
+                file_location=None, filename=None):
+    """Puts the partial results of a crawl together
+
+    Parameters
+    ----------
+    queue_path : `str`
+    output_folder : `str`
+        Folder the workers saved their partial results in
+    kind : `str`, optional (default: "user")
+    write : `bool`, optional (default: True)
+        If true, writes an excel file and returns `None`
+        False returns a DataFrame
+    file_location : `str`, optional
+    filename : `str`, optional
+        Defaults to the file `get_all_users` or `get_all_attendance` writes
+
+    """
+    _check_kind(kind)
+    queue = WorkQueue(queue_path)
+    try:
+        progress = queue.progress(kind)
+        if progress["pending"] or progress["leased"]:
+            print(f"Warning: {progress['pending'] + progress['leased']} {kind} "
+                  "batches are not done yet")
+        for batch_id, uids, error in queue.failed(kind):
+            print(f"Warning: {kind} batch {batch_id} failed and is missing from "
+                  f"the result (uids {uids}): {error}")
+        outputs = queue.outputs(kind)
+    finally:
+        queue.close()
+
+    frames = [pd.read_pickle(os.path.join(output_folder, output), compression=None)
+              for output in outputs]
+    big_df = pd.concat(frames, sort=False) if frames else pd.DataFrame()
+
+    if write:
+        if filename is None:
+            filename = CRAWL_KINDS[kind]
+        full_path = os.path.join(tools._download_location(file_location), filename)
+        big_df.to_excel(full_path)
+        return
+    else:
+        return big_df
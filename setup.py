@@ -36,6 +36,7 @@ REQUIRED = [
 
 # What packages are optional?
 EXTRAS = {
+    "arrow": ["pyarrow"],
 }
 
 # The rest you shouldn't have to touch too much :)